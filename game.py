@@ -1,6 +1,9 @@
+from __future__ import annotations
+from array import array
 from dataclasses import dataclass, field
+from typing import Iterator, Optional
 import math
-from queue import PriorityQueue
+import heapq
 import pygame
 import pygame.gfxdraw
 
@@ -10,6 +13,7 @@ SELECT_COLOR     = (200,200,200)
 PLAYER_COLOR     = (80,80,80)
 GRID_OFFSET      = 5
 PLAYER_SPEED     = 1.0
+FRAME_RATE       = 60
 HEX_COLORS       = (
     (180,120,120),
     (120,180,120),
@@ -34,17 +38,26 @@ hex_vertices = [
 
 game_running = True
 draw_edges   = True
-class Hexagon:
-    pass
 
 @dataclass
 class HexGrid:
     height:   int                 = field(init=True, compare=True)
     width:    int                 = field(init=True, compare=True)
     hexagons: list[list[Hexagon]] = field(init=False,compare=False,default_factory=list)
-    selected_hex: Hexagon         = None
+    flat_hexagons: list[Hexagon]  = field(init=False, compare=False, default_factory=list)
+    flat_neighbors: list[tuple[int, ...]] = field(init=False, compare=False, default_factory=list)
+    blocked:  bytearray           = field(init=False, compare=False, default_factory=bytearray)
+    blocked_version: int          = field(init=False, compare=False, default=0)
+    selected_hex: Optional[Hexagon] = None
+    dirty:    list[pygame.Rect]   = field(init=False, compare=False, default_factory=list)
+    stale:    list[pygame.Rect]   = field(init=False, compare=False, default_factory=list)
+    _surface: Optional[pygame.Surface] = field(init=False, compare=False, default=None)
+    _scratch: Optional[pygame.Surface] = field(init=False, compare=False, default=None)
+    pixel_to_hex: array           = field(init=False, compare=False, default_factory=lambda: array('h'))
+    lookup_size: tuple[int, int]  = field(init=False, compare=False, default=(0, 0))
+    _rects:   list[pygame.Rect]   = field(init=False, compare=False, default_factory=list)
     
-    def __post_init__(self):
+    def __post_init__(self) -> None:
         self.hexagons = [
             [Hexagon(HEX_COLORS[(j + 2*(i%2)) % 3], (j,i)) for j in range(self.width - (i%2))] 
             for i in range(self.height) 
@@ -60,76 +73,198 @@ class HexGrid:
                 hex.neighbors.down_right = self[irow+1, right]
                 hex.neighbors.left       = self[irow, icol-1]
                 hex.neighbors.right      = self[irow, icol+1]
+        self.flat_hexagons = [hex for row in self.hexagons for hex in row]
+        for index, hex in enumerate(self.flat_hexagons):
+            hex.index = index
+            hex.neighbors.cache()
+        self.flat_neighbors = [tuple(n.index for n in hex.neighbors) for hex in self.flat_hexagons]
+        self.blocked = bytearray(hex.blocked for hex in self.flat_hexagons)
+        self._rects = [hex.rect for hex in self.flat_hexagons]
 
-
-    def __getitem__(self, key: tuple[int]) -> Hexagon:
+    def __getitem__(self, key: tuple[int, int]) -> Optional[Hexagon]:
         if key[0] < 0 or key[0] >= len(self.hexagons): return None
         if key[1] < 0 or key[1] >= len(self.hexagons[key[0]]): return None
         return self.hexagons[key[0]][key[1]]
 
-    def draw(self):
-        for row in self.hexagons:
-            for hex in row:
-                hex.draw()
-
-class NeighborhoodIter:
-    def __init__(self, neighbors: list[Hexagon]) -> None:
-        self.neighbors = neighbors
-        self.index = 0
-    def __next__(self) -> Hexagon:
-        if self.index < len(self.neighbors):
-            result = self.neighbors[self.index]
-            self.index += 1
-            return result
-        else:
-            raise StopIteration
+    def build_pixel_lookup(self, width: int, height: int) -> None:
+        '''Maps every pixel of a width x height screen to the flat index of the hexagon under it, or -1.'''
+        self.lookup_size = (width, height)
+        self.pixel_to_hex = array('h', [-1]) * (width * height)
+        # rows above the grid offset stay unmapped, so relative_row is never negative below
+        for y in range(GRID_OFFSET, height):
+            relative_row = (y - GRID_OFFSET) / three_quart_height
+            row          = int(relative_row)
+            row_fract    = relative_row - row
+            for x in range(width):
+                mouse_row    = row
+                odd_row      = mouse_row % 2
+
+                relative_col = (x - GRID_OFFSET - odd_row * half_width) / hex_width
+                col_fract    = 0.5 - (relative_col % 1)
+                mouse_col    = math.floor(relative_col)
+
+                if 2 * row_fract < abs(col_fract) + POINTER_OFFSET:
+                    odd_row = 1 - odd_row
+                    mouse_row -= 1
+                    mouse_col += (col_fract < 0) - odd_row
+
+                hex = self[mouse_row, mouse_col]
+                if hex:
+                    self.pixel_to_hex[y * width + x] = hex.index
+
+    def hex_at(self, pos: tuple[int, int]) -> Optional[Hexagon]:
+        '''Hexagon under the given screen pixel, or None.'''
+        x, y = pos
+        if 0 <= x < self.lookup_size[0] and 0 <= y < self.lookup_size[1]:
+            index = self.pixel_to_hex[y * self.lookup_size[0] + x]
+            if index >= 0:
+                return self.flat_hexagons[index]
+        return None
+
+    def toggle_blocked(self, hex: Hexagon) -> None:
+        hex.blocked = not hex.blocked
+        self.blocked[hex.index] = hex.blocked
+        self.blocked_version += 1
+        self.invalidate(hex.rect)
+
+    def invalidate(self, rect: pygame.Rect) -> None:
+        '''Marks a region whose hexagons changed, so it is re-rendered and put on screen.'''
+        self.stale.append(rect)
+        self.dirty.append(rect)
+
+    def draw(self) -> None:
+        '''Re-renders the stale regions of the cached grid surface and blits the dirty rects to the screen.'''
+        if self._surface is None or self._scratch is None:
+            self._surface = pygame.Surface(screen.get_size())
+            self._scratch = pygame.Surface(screen.get_size())
+            self.stale = [self._surface.get_rect()]
+        # hexagons are drawn whole onto the scratch surface, clipping would shift their antialiased edges
+        for rect in self.stale:
+            self._scratch.fill(BACKGROUND_COLOR, rect)
+            for i in rect.collidelistall(self._rects):
+                self.flat_hexagons[i].draw(self._scratch)
+            self._surface.blit(self._scratch, rect, rect)
+        self.stale.clear()
+        screen.blits([(self._surface, rect, rect) for rect in self.dirty], doreturn=False)
+
 @dataclass
 class HexNeighborhood:
-    left:       Hexagon = None
-    right:      Hexagon = None
-    up_left:    Hexagon = None
-    up_right:   Hexagon = None
-    down_left:  Hexagon = None
-    down_right: Hexagon = None
+    left:       Optional[Hexagon] = None
+    right:      Optional[Hexagon] = None
+    up_left:    Optional[Hexagon] = None
+    up_right:   Optional[Hexagon] = None
+    down_left:  Optional[Hexagon] = None
+    down_right: Optional[Hexagon] = None
+    _cached:    tuple[Hexagon, ...] = field(default=(), repr=False, compare=False)
 
-    def __iter__(self):
-        return NeighborhoodIter([n for n in [self.up_left, self.up_right, self.right, self.down_right, self.down_left, self.left] if n])
+    def cache(self) -> None:
+        '''Stores the existing neighbors for iteration. Call after all neighbors are linked.'''
+        self._cached = tuple(n for n in (self.up_left, self.up_right, self.right, self.down_right, self.down_left, self.left) if n)
+
+    def __iter__(self) -> Iterator[Hexagon]:
+        return iter(self._cached)
 
 @dataclass(unsafe_hash=True)
 class Hexagon:
-    color:       tuple[int]       = field(compare=False, hash=False)
-    position:    tuple[int]       = field(compare=True, repr=True, hash=True)
-    vertices:    list[tuple[int]] = field(init=False, compare=False, default_factory=list, hash=False)
-    center:      tuple[float]     = field(init=False, compare=False, hash=False)
+    color:       tuple[int, int, int] = field(compare=False, hash=False)
+    position:    tuple[int, int]  = field(compare=True, repr=True, hash=True)
+    vertices:    tuple[tuple[int, int], ...] = field(init=False, compare=False, default=(), hash=False)
+    center:      tuple[float, float] = field(init=False, compare=False, hash=False)
+    cube:        tuple[int, int, int] = field(init=False, compare=False, hash=False)
+    index:       int              = field(init=False, compare=False, hash=False, default=-1)
+    rect:        pygame.Rect      = field(init=False, compare=False, hash=False)
     neighbors:   HexNeighborhood  = field(init=False, compare=False, default_factory=HexNeighborhood, hash=False)
     highlighted: bool             = False
     blocked:     bool             = False
     
-    def __post_init__(self):
-        self.vertices = [(
-            v[0] + GRID_OFFSET + self.position[0] * hex_width + (self.position[1] % 2 * half_width), 
-            v[1] + GRID_OFFSET + self.position[1] * three_quart_height)
-        for v in hex_vertices]
+    def __post_init__(self) -> None:
+        left = GRID_OFFSET + self.position[0] * hex_width + (self.position[1] % 2 * half_width)
+        top  = GRID_OFFSET + self.position[1] * three_quart_height
+        self.vertices = tuple((int(v[0] + left), int(v[1] + top)) for v in hex_vertices)
             
-        self.center = (self.vertices[0][0], (self.vertices[1][1] + self.vertices[2][1]) / 2.0)
-    
-    def draw(self):
+        self.center = (left + half_width, top + HEX_HEIGHT / 2.0)
+
+        # odd rows are shifted right by half a hexagon
+        col, row = self.position
+        x = col - (row - row % 2) // 2
+        self.cube = (x, -x - row, row)
+        # one extra pixel on every side for the antialiased edges
+        self.rect = pygame.Rect(self.vertices[5][0], self.vertices[0][1],
+                                self.vertices[1][0] - self.vertices[5][0] + 1, self.vertices[3][1] - self.vertices[0][1] + 1).inflate(2, 2)
+
+    def draw(self, surface: pygame.Surface) -> None:
         face_color = BACKGROUND_COLOR if self.blocked else SELECT_COLOR if self.highlighted else self.color
         edge_color = (0,0,0) if draw_edges else face_color
-        pygame.draw.polygon(screen, face_color, self.vertices, 0)
-        pygame.gfxdraw.aapolygon(screen, self.vertices, edge_color)
+        pygame.draw.polygon(surface, face_color, self.vertices, 0)
+        pygame.gfxdraw.aapolygon(surface, self.vertices, edge_color)
+
+@dataclass
+class SearchFront:
+    '''State of one direction of the bidirectional A* search in Player.find_path, keyed by flat hexagon index.'''
+    hex_grid:   HexGrid             = field(compare=False)
+    start:      int                 = field(compare=False)
+    goal:       int                 = field(compare=False)
+    came_from:  dict[int, Optional[int]] = field(compare=False, init=False, default_factory=dict)
+    g_score:    dict[int, int]      = field(compare=False, init=False, default_factory=dict)
+    h_cache:    dict[int, int]      = field(compare=False, init=False, default_factory=dict)
+    q:          list[tuple[int, int, int]] = field(compare=False, init=False, default_factory=list)
+    q_count:    int                 = field(compare=False, init=False, default=0)
+    goal_cube:  tuple[int, int, int] = field(compare=False, init=False)
+
+    def __post_init__(self) -> None:
+        self.goal_cube = self.hex_grid.flat_hexagons[self.goal].cube
+        self.came_from[self.start] = None
+        self.g_score[self.start] = 0
+        heapq.heappush(self.q, (self.h(self.start), self.q_count, self.start))
+
+    def h(self, node: int, abs=abs) -> int:
+        '''Hex distance from node to the goal in cube coordinates, memoized per search.'''
+        score = self.h_cache.get(node)
+        if score is None:
+            x, y, z = self.hex_grid.flat_hexagons[node].cube
+            goal_x, goal_y, goal_z = self.goal_cube
+            score = self.h_cache[node] = (abs(x - goal_x) + abs(y - goal_y) + abs(z - goal_z)) // 2
+        return score
+
+    @property
+    def min_f(self) -> float:
+        return self.q[0][0] if self.q else math.inf
+
+    def step(self) -> list[int]:
+        '''Expands the best open node. Returns the neighbors whose g_score improved.'''
+        q, g_score, came_from = self.q, self.g_score, self.came_from
+        blocked, inf, heappush = self.hex_grid.blocked, math.inf, heapq.heappush
+
+        f, _, current_node = heapq.heappop(q)
+        if f > g_score[current_node] + self.h(current_node): # outdated entry, node was pushed again with a better score
+            return []
+        score: int = g_score[current_node] + 1
+        improved: list[int] = []
+        for neighbor in self.hex_grid.flat_neighbors[current_node]:
+            if blocked[neighbor] or score >= g_score.get(neighbor, inf):
+                continue
+            g_score[neighbor] = score
+            came_from[neighbor] = current_node
+            improved.append(neighbor)
+            self.q_count += 1
+            heappush(q, (score + self.h(neighbor), self.q_count, neighbor))
+        return improved
 
 @dataclass
 class Player:
-    color:    tuple[int]    = field(compare=False)
+    color:    tuple[int, int, int] = field(compare=False)
     position: Hexagon       = field(compare=False)
     hex_grid: HexGrid       = field(compare=False)
-    center:   tuple[float]  = field(compare=False, init=False)
+    center:   tuple[float, float] = field(compare=False, init=False)
     path:     list[Hexagon] = field(compare=False, init=False, default_factory=list)
-    _destination: Hexagon   = None
+    path_centers: list[tuple[float, float]] = field(compare=False, init=False, default_factory=list)
+    rect:     pygame.Rect   = field(compare=False, init=False)
+    changed:  bool          = field(compare=False, init=False, default=True)
+    _destination: Optional[Hexagon] = None
+    _last_plan: Optional[tuple] = field(compare=False, init=False, default=None)
 
     @property
-    def destination(self) -> Hexagon:
+    def destination(self) -> Optional[Hexagon]:
         return self._destination
 
     @destination.setter
@@ -138,65 +273,65 @@ class Player:
             self._destination = new_dest
             self.find_path()
 
-    def __post_init__(self):
+    def __post_init__(self) -> None:
         self.center = self.position.center
+        self.rect = pygame.Rect(self.center, (0, 0))
     
-    def draw(self):
-        pygame.draw.circle(screen, self.color, self.center, quart_height)
-        if len(self.path) > 1:
-            pygame.draw.lines(screen, self.color, False, [hexagon.center for hexagon in self.path], 3)
+    def draw(self) -> None:
+        '''Draws the player and its path, remembering the covered area in self.rect.'''
+        self.rect = pygame.draw.circle(screen, self.color, self.center, quart_height)
+        if len(self.path_centers) > 1:
+            self.rect.union_ip(pygame.draw.lines(screen, self.color, False, self.path_centers, 3))
     
-    def move(self, position_hex: Hexagon):
+    def move(self, position_hex: Optional[Hexagon]) -> None:
         if position_hex and not position_hex.blocked:
             self.position = position_hex
             self.center = position_hex.center
+            self.changed = True
             self.find_path()
 
-    def find_path(self) -> None:
-        '''A* path finding. Sets player's path to current destination.'''
-        def h(a: Hexagon, b: Hexagon) -> float:
-            return math.fabs(a.position[0] - b.position[0]) + math.fabs(a.position[1] - b.position[1])
-        
+    def find_path(self) -> bool:
+        '''Bidirectional A* path finding. Sets player's path to current destination.'''
         if self.destination:
-            came_from = {self.position: None}
+            plan = (self.position, self.destination, self.hex_grid.blocked_version)
+            if self.path and plan == self._last_plan:
+                return True
+            self._last_plan = plan
             self.path = []
+            self.path_centers = []
+            self.changed = True
+            if self.destination.blocked:
+                return False
 
-            q_count = 0
-            q = PriorityQueue()
-            q.put((0, q_count, self.position))
-            open_nodes = {self.position}
-            
-            f_score = {node: math.inf for row in self.hex_grid.hexagons for node in row}
-            f_score[self.position] = h(self.position, self.destination)
-            
-            g_score = {node: math.inf for row in self.hex_grid.hexagons for node in row}
-            g_score[self.position] = 0
-
-            while not q.empty():
-                current_node = q.get()[2]
-                open_nodes.remove(current_node)
-                if current_node == self.destination:
-                    while current_node:
-                        self.path.insert(0, current_node)
-                        current_node = came_from[current_node]
-                    return True
-                for neighbor in [n for n in current_node.neighbors if not n.blocked]:
-                    score = g_score[current_node] + 1
-                    if score < g_score[neighbor]:
-                        g_score[neighbor] = score
-                        f_score[neighbor] = score + h(neighbor, self.destination)
-                        came_from[neighbor] = current_node
-                        if neighbor not in open_nodes:
-                            open_nodes.add(neighbor)
-                            q_count += 1
-                            q.put((f_score[neighbor], q_count, neighbor))
+            forward  = SearchFront(self.hex_grid, self.position.index, self.destination.index)
+            backward = SearchFront(self.hex_grid, self.destination.index, self.position.index)
+            best, meet = (0, self.position.index) if self.position == self.destination else (math.inf, None)
+
+            front, other = forward, backward
+            while max(forward.min_f, backward.min_f) < best:
+                for node in front.step():
+                    if node in other.g_score and front.g_score[node] + other.g_score[node] < best:
+                        best, meet = front.g_score[node] + other.g_score[node], node
+                front, other = other, front
+
+            if meet is not None:
+                flat_hexagons = self.hex_grid.flat_hexagons
+                index: Optional[int] = meet
+                while index is not None:
+                    self.path.insert(0, flat_hexagons[index])
+                    index = forward.came_from[index]
+                index = backward.came_from[meet]
+                while index is not None:
+                    self.path.append(flat_hexagons[index])
+                    index = backward.came_from[index]
+                self.path_centers = [hexagon.center for hexagon in self.path]
+                return True
         return False
             
 
-
 if __name__ == '__main__':
     hex_grid = HexGrid(GRID_HEIGHT,GRID_WIDTH)
-    player   = Player(PLAYER_COLOR, hex_grid[0, 0], hex_grid)
+    player   = Player(PLAYER_COLOR, hex_grid.hexagons[0][0], hex_grid)
 
     pygame.init()
     pygame.display.set_caption('Hex_star')
@@ -205,6 +340,8 @@ if __name__ == '__main__':
     disp_width = math.ceil(hex_width * hex_grid.width + 2 * GRID_OFFSET)
     disp_height = three_quart_height * hex_grid.height + quart_height + 2 * GRID_OFFSET
     screen = pygame.display.set_mode(size = (disp_width, disp_height))
+    hex_grid.dirty.append(screen.get_rect())
+    hex_grid.build_pixel_lookup(*screen.get_size())
 
     frames = 0
     delta_time = 0
@@ -217,13 +354,14 @@ if __name__ == '__main__':
                 if event.button == 1 and hex_grid.selected_hex: #left click on selected hex
                     player.destination = hex_grid.selected_hex
                 if event.button == 3 and hex_grid.selected_hex: #left click on selected hex
-                    hex_grid.selected_hex.blocked = not hex_grid.selected_hex.blocked
+                    hex_grid.toggle_blocked(hex_grid.selected_hex)
                     player.find_path()
             elif event.type == pygame.KEYDOWN:
                 if event.key == pygame.K_ESCAPE:
                     game_running = False
                 elif event.key == pygame.K_g:
                     draw_edges = not draw_edges
+                    hex_grid.invalidate(screen.get_rect())
                 elif event.key == pygame.K_d:
                     player.move(player.position.neighbors.right)
                 elif event.key == pygame.K_a:
@@ -237,41 +375,32 @@ if __name__ == '__main__':
                 elif event.key == pygame.K_q:
                     player.move(player.position.neighbors.up_left)
             elif event.type == pygame.MOUSEMOTION:
-                mouse_x      = event.pos[0] - GRID_OFFSET
-                mouse_y      = event.pos[1] - GRID_OFFSET
-                relative_row = mouse_y / three_quart_height
-                row_fract    = relative_row % 1
-                mouse_row    = math.floor(relative_row)
-                odd_row      = mouse_row % 2
-                
-                relative_col = (mouse_x - odd_row * half_width) / hex_width
-                col_fract    = 0.5 - (relative_col % 1)
-                mouse_col    = math.floor(relative_col)
-
-                if 2 * row_fract < math.fabs(col_fract) + POINTER_OFFSET:
-                    odd_row = 1 - odd_row
-                    mouse_row -= 1
-                    mouse_col += (col_fract < 0) - odd_row
-
-                mouse_hex = hex_grid[mouse_row, mouse_col]
+                mouse_hex = hex_grid.hex_at(event.pos)
                 if hex_grid.selected_hex != mouse_hex:
                     if hex_grid.selected_hex:
                         hex_grid.selected_hex.highlighted = False
                         for neighbor in hex_grid.selected_hex.neighbors:
                             neighbor.highlighted = False
+                        hex_grid.invalidate(hex_grid.selected_hex.rect.unionall([n.rect for n in hex_grid.selected_hex.neighbors]))
         
                     hex_grid.selected_hex = mouse_hex
                     if hex_grid.selected_hex:                
                         hex_grid.selected_hex.highlighted = True
                         for neighbor in hex_grid.selected_hex.neighbors:
                             neighbor.highlighted = True
+                        hex_grid.invalidate(hex_grid.selected_hex.rect.unionall([n.rect for n in hex_grid.selected_hex.neighbors]))
 
-        # clock.tick()
-        # print(f'\r{int(clock.get_fps())}', end='')
+        if player.changed:
+            hex_grid.dirty.append(player.rect)
+        if hex_grid.dirty:
+            hex_grid.draw()
+            player.draw()
+            if player.changed:
+                hex_grid.dirty.append(player.rect)
+                player.changed = False
+            pygame.display.update(hex_grid.dirty)
+            hex_grid.dirty.clear()
 
-        screen.fill(color=BACKGROUND_COLOR)
-        hex_grid.draw()
-        player.draw()
-        pygame.display.update()
+        clock.tick(FRAME_RATE)
 
     pygame.quit()
\ No newline at end of file